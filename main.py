@@ -1,12 +1,14 @@
 import logging
 import logging.config
-from fastapi import FastAPI, HTTPException
+from fastapi import Depends, FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse, Response
 
-from src.config.settings import API_TITLE, API_DESCRIPTION, API_VERSION, LOGGING_CONFIG
-from src.models.chat import ChatRequest, ChatResponse
+from src.config.settings import API_TITLE, API_DESCRIPTION, API_VERSION, LOGGING_CONFIG, WEB_CONCURRENCY
+from src.models.chat import ChatRequest, ChatResponse, ChatBatchRequest, ChatBatchResponse
 from src.models.chat_history import ChatHistoryResponse
 from src.services.chat_service import ChatService
+from src.middleware.timing import RequestTimingMiddleware
 from contextlib import asynccontextmanager
 
 # Configure logging
@@ -22,17 +24,22 @@ async def lifespan(app: FastAPI):
     global chat_service
     chat_service = await ChatService.create()
     yield
-    # Shutdown: Add any cleanup code here if needed
-    pass
+    # Shutdown: Release the shared S3 client
+    await chat_service.close()
 
 # Initialize FastAPI app
 app = FastAPI(
     title=API_TITLE,
     description=API_DESCRIPTION,
     version=API_VERSION,
-    lifespan=lifespan
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse
 )
 
+def get_chat_service() -> ChatService:
+    """Dependency returning the chat service started by the lifespan; overridden in tests."""
+    return chat_service
+
 # Add CORS middleware
 app.add_middleware(
     CORSMiddleware,
@@ -40,20 +47,35 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Response-Time"],
 )
+# Added last so it is outermost and the header covers the CORS handling too
+app.add_middleware(RequestTimingMiddleware)
 
 @app.post("/chat", response_model=ChatResponse)
-async def chat(request: ChatRequest):
+async def chat(request: ChatRequest, service: ChatService = Depends(get_chat_service)):
     try:
-        return await chat_service.process_chat(request)
+        response = await service.process_chat(request)
+        if isinstance(response, bytes):
+            # Pre-encoded fallback body; the Response itself must be new for every request
+            return Response(content=response, media_type="application/json")
+        return response
     except Exception as e:
         logger.error(f"Error in chat endpoint: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/chat/batch", response_model=ChatBatchResponse)
+async def chat_batch(batch: ChatBatchRequest, service: ChatService = Depends(get_chat_service)):
+    try:
+        return await service.process_chat_batch(batch)
+    except Exception as e:
+        logger.error(f"Error in chat batch endpoint: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
 @app.get("/chat/history/{thread_id}", response_model=ChatHistoryResponse)
-async def get_chat_history(thread_id: str):
+async def get_chat_history(thread_id: str, service: ChatService = Depends(get_chat_service)):
     try:
-        response = await chat_service.get_chat_history(thread_id)
+        response = await service.get_chat_history(thread_id)
         if not response.messages:
             raise HTTPException(status_code=404, detail=f"No chat history found for thread {thread_id}")
         return response
@@ -66,4 +88,4 @@ async def get_chat_history(thread_id: str):
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    uvicorn.run("main:app", host="0.0.0.0", port=8000, loop="uvloop", http="httptools", workers=WEB_CONCURRENCY)
\ No newline at end of file
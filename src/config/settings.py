@@ -13,10 +13,21 @@ API_TITLE = "Production Chatbot API"
 API_DESCRIPTION = "A production-ready async chatbot API"
 API_VERSION = "1.0.0"
 
+# Server Configuration
+# Chat histories are cached per process, so only raise this behind a load balancer
+# that routes each thread_id to the same worker
+WEB_CONCURRENCY = int(os.getenv("WEB_CONCURRENCY", "1"))
+# Requests accepted by one /chat/batch call; each may run concurrently against S3
+MAX_BATCH_SIZE = 20
+
 # Model Configuration
 MODEL_NAME =  "llama3-8b-8192" #"deepseek-reasoner"    
 RATE_LIMIT_CALLS = 50
 RATE_LIMIT_PERIOD = 60
+ANSWER_CACHE_SIZE = 4096
+SESSION_CACHE_SIZE = 4096  # sessions whose history is kept in memory
+CHECKPOINT_FLUSH_INTERVAL = 0.1  # seconds
+CHECKPOINT_CLOSE_RETRIES = 3
 BASE_URL="https://api.deepseek.com"
 
 # Environment Variables
@@ -29,6 +40,7 @@ AWS_ACCESS_KEY_ID = os.getenv("AWS_ACCESS_KEY_ID")
 AWS_SECRET_ACCESS_KEY = os.getenv("AWS_SECRET_ACCESS_KEY")
 AWS_REGION = os.getenv("AWS_REGION", "us-east-1")
 S3_BUCKET_NAME = os.getenv("S3_BUCKET_NAME")
+QA_PAIRS_KEY = os.getenv("QA_PAIRS_KEY", "knowledge_base/qa_pairs.json")
 DEEPSEEK_API_KEY = os.getenv("DEEPSEEK_API_KEY") 
 
 # Logging Configuration
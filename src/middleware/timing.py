@@ -0,0 +1,29 @@
+import time
+from starlette.datastructures import MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+class RequestTimingMiddleware:
+    """Pure ASGI middleware adding an X-Response-Time header with the server-side latency.
+
+    Measured up to the start of the response, so it covers routing, validation and the
+    chat service but not the client or the transport. Written as a plain ASGI callable:
+    BaseHTTPMiddleware would add a task and a streamed copy of the body to every request.
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+
+        async def send_with_timing(message: Message) -> None:
+            if message["type"] == "http.response.start":
+                headers = MutableHeaders(scope=message)
+                headers.append("X-Response-Time", f"{(time.perf_counter() - start) * 1000:.2f}ms")
+            await send(message)
+
+        await self.app(scope, receive, send_with_timing)
@@ -1,7 +1,9 @@
 from typing import List, Optional
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 from datetime import datetime
 
+from ..config.settings import MAX_BATCH_SIZE
+
 class ChatRequest(BaseModel):
     message: str
     language: str = "English"
@@ -10,4 +12,10 @@ class ChatRequest(BaseModel):
 class ChatResponse(BaseModel):
     response: str
     language: str
-    timestamp: datetime = None
\ No newline at end of file
+    timestamp: Optional[datetime] = None
+
+class ChatBatchRequest(BaseModel):
+    requests: List[ChatRequest] = Field(..., max_length=MAX_BATCH_SIZE)
+
+class ChatBatchResponse(BaseModel):
+    responses: List[ChatResponse]
\ No newline at end of file
@@ -1,60 +1,132 @@
 import os
+import re
+import time
+import asyncio
 import logging
-from typing import List, Optional
+from collections import defaultdict
+from contextlib import asynccontextmanager
+from hashlib import blake2b
+from typing import List, Optional, Union
 from datetime import datetime
 
+import aioboto3
+from aiolimiter import AsyncLimiter
+from cachetools import LRUCache
 from langchain_core.messages import HumanMessage, BaseMessage
 from langchain_core.runnables import RunnableConfig
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
 from langchain_groq import ChatGroq
 from langchain_openai import ChatOpenAI
-from ratelimit import limits, sleep_and_retry
 from langgraph.checkpoint.memory import MemorySaver
 from langgraph.graph import START, MessagesState, StateGraph
 
-from ..config.settings import MODEL_NAME, BASE_URL, RATE_LIMIT_CALLS, RATE_LIMIT_PERIOD, AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY, AWS_REGION, S3_BUCKET_NAME
+from ..config.settings import MODEL_NAME, BASE_URL, ANSWER_CACHE_SIZE, SESSION_CACHE_SIZE, CHECKPOINT_FLUSH_INTERVAL, CHECKPOINT_CLOSE_RETRIES, RATE_LIMIT_CALLS, RATE_LIMIT_PERIOD, AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY, AWS_REGION, S3_BUCKET_NAME, QA_PAIRS_KEY
 from .s3_memory_saver import S3MemorySaver
-from ..models.chat import ChatRequest, ChatResponse
+from ..models.chat import ChatRequest, ChatResponse, ChatBatchRequest, ChatBatchResponse
 from ..models.chat_history import ChatHistoryResponse, Message
 from typing_extensions import TypedDict
-import json
+import orjson
 from langchain_core.messages import AIMessage
 
+try:
+    import ahocorasick
+except ImportError:  # C extension; fall back to precompiled regexes without it
+    ahocorasick = None
+
 logger = logging.getLogger(__name__)
 
+FALLBACK_ANSWER = "I can only answer questions about our business operations."
+
+MESSAGE_ROLES = {HumanMessage: "human", AIMessage: "assistant"}
+
+def _message_time(message: BaseMessage, default: datetime) -> datetime:
+    """Return when a message was created, from the "ts" stamped into additional_kwargs."""
+    ts = message.additional_kwargs.get("ts")
+    return datetime.fromtimestamp(ts) if ts is not None else default
+
+# Enhanced topic keywords with more variations
+TOPIC_KEYWORDS = {
+    "business hours": ["hour", "open", "close", "time", "operating", "when do you"],
+    "password reset": [
+        "password", "login", "account", "reset", "forgot", 
+        "recover", "change", "update", "lost", "cant log", "can't log",
+        "how do i reset", "how to reset", "how can i reset"
+    ],
+    "payment methods": ["pay", "payment", "credit card", "invoice", "method", "how to pay"],
+    "customer support": ["contact", "support", "help", "email", "phone", "reach", "speak to"],
+    "refund policy": ["refund", "return", "money back", "guarantee", "cancel", "get money back"]
+}
+
 class Configuration(TypedDict):
     thread_id: str
 
 class ChatService:
     def __init__(self):
         self.llm = None
+        # Budget for remote calls through self.llm; knowledge base lookups are not limited
+        self.limiter = AsyncLimiter(RATE_LIMIT_CALLS, RATE_LIMIT_PERIOD)
         self.memory = None
-        self.chat_histories = {}
+        # Bounded so idle sessions fall back to S3 instead of growing the process forever
+        self.chat_histories = LRUCache(maxsize=SESSION_CACHE_SIZE)
+        self.chat_languages = LRUCache(maxsize=SESSION_CACHE_SIZE)
+        # session_id -> [lock, number of turns holding or waiting for it]
+        self._session_locks = {}
         self.prompt_template = None
         self.workflow = None
         self.workflow_app = None
+        self.s3_client = None
+        self._s3_client_ctx = None
+        self._answer_cache = LRUCache(maxsize=ANSWER_CACHE_SIZE)
+        # language -> shared response for out-of-domain questions
+        self._fallback_payloads = LRUCache(maxsize=64)
+        self._qa_index = []
+        self._topic_answers = {}
+        self._matcher = None
+        self._topic_re = {}
+        self._pending_checkpoints = {}
+        # Checkpoints taken off the queue by the current flush and not yet confirmed written
+        self._writing_checkpoints = {}
+        self._flush_event = asyncio.Event()
+        self._checkpoint_writer_task = None
+        self._closing = False
 
     @classmethod
     async def create(cls):
         service = cls()
         service.llm = service._create_llm()
-        service.memory = S3MemorySaver(
-            bucket_name=S3_BUCKET_NAME,
+        # One S3 client for the lifetime of the service so every request reuses
+        # the same connection pool instead of paying client setup and TLS again
+        service._s3_client_ctx = aioboto3.Session().client(
+            's3',
             aws_access_key_id=AWS_ACCESS_KEY_ID,
             aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
             region_name=AWS_REGION
         )
-        
-        # Load QA pairs from JSON file
+        service.s3_client = await service._s3_client_ctx.__aenter__()
         try:
-            qa_pairs_obj = await service.memory.s3_client.get_object(
-                Bucket=S3_BUCKET_NAME,
-                Key="knowledge_base/qa_pairs.json"
+            service.memory = S3MemorySaver(
+                bucket_name=S3_BUCKET_NAME,
+                aws_access_key_id=AWS_ACCESS_KEY_ID,
+                aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
+                region_name=AWS_REGION,
+                s3_client=service.s3_client
             )
-            qa_pairs_data = await qa_pairs_obj['Body'].read()
-            service.qa_pairs = json.loads(qa_pairs_data.decode('utf-8'))["qa_pairs"]
-        except Exception as e:
-            logger.error(f"Failed to load QA pairs from S3: {str(e)}")
+
+            # Load QA pairs from JSON file
+            try:
+                qa_pairs_obj = await service.s3_client.get_object(
+                    Bucket=S3_BUCKET_NAME,
+                    Key=QA_PAIRS_KEY
+                )
+                qa_pairs_data = await qa_pairs_obj['Body'].read()
+                service.qa_pairs = orjson.loads(qa_pairs_data)["qa_pairs"]
+            except Exception as e:
+                logger.error(f"Failed to load QA pairs from S3: {str(e)}")
+                raise
+            service._index_knowledge_base()
+        except Exception:
+            # Release the client opened above instead of leaking it when startup fails
+            await service.close()
             raise
         
         service.prompt_template = ChatPromptTemplate.from_messages([
@@ -72,10 +144,30 @@ class ChatService:
         ])
         service.workflow = service._setup_workflow()
         service.workflow_app = service.workflow.compile(checkpointer=service.memory)
+        service._checkpoint_writer_task = asyncio.create_task(service._run_checkpoint_writer())
         return service
 
-    @sleep_and_retry
-    @limits(calls=RATE_LIMIT_CALLS, period=RATE_LIMIT_PERIOD)
+    async def close(self) -> None:
+        """Flush queued checkpoints and release the shared S3 client."""
+        if self._checkpoint_writer_task is not None:
+            self._closing = True
+            self._flush_event.set()
+            await self._checkpoint_writer_task
+            self._checkpoint_writer_task = None
+            # The writer's last flush may have re-queued failed writes; retry them before exiting
+            for _ in range(CHECKPOINT_CLOSE_RETRIES):
+                if not self._pending_checkpoints:
+                    break
+                await self._flush_checkpoints()
+            if self._pending_checkpoints:
+                logger.error(
+                    f"Dropping unsaved checkpoints on shutdown: {sorted(self._pending_checkpoints)}"
+                )
+        if self._s3_client_ctx is not None:
+            await self._s3_client_ctx.__aexit__(None, None, None)
+            self._s3_client_ctx = None
+            self.s3_client = None
+
     def _create_llm(self):
         return ChatGroq(model=MODEL_NAME)
         # return ChatOpenAI(base_url=BASE_URL,
@@ -90,59 +182,102 @@ class ChatService:
 
 
     async def _call_model(self, state: MessagesState, config: RunnableConfig):
-        try:
-            logger.info(f"Current state messages count: {len(state['messages'])}")
-            last_message = state['messages'][-1].content.lower()
-            
-            # Enhanced topic keywords with more variations
-            topic_keywords = {
-                "business hours": ["hour", "open", "close", "time", "operating", "when do you"],
-                "password reset": [
-                    "password", "login", "account", "reset", "forgot", 
-                    "recover", "change", "update", "lost", "cant log", "can't log",
-                    "how do i reset", "how to reset", "how can i reset"
-                ],
-                "payment methods": ["pay", "payment", "credit card", "invoice", "method", "how to pay"],
-                "customer support": ["contact", "support", "help", "email", "phone", "reach", "speak to"],
-                "refund policy": ["refund", "return", "money back", "guarantee", "cancel", "get money back"]
-            }
-            
-            # First check for exact matches
-            for pair in self.qa_pairs:
-                if pair["question"].lower() in last_message:
-                    return {
-                        "messages": state['messages'] + [
-                            AIMessage(content=pair["answer"])
-                        ]
-                    }
-            
-            # Then check for related questions with more flexible matching
-            for topic, keywords in topic_keywords.items():
-                if any(f" {kw} " in f" {last_message} " for kw in keywords):
-                    relevant_pair = next((p for p in self.qa_pairs if topic in p["question"].lower()), None)
-                    if relevant_pair:
-                        return {
-                            "messages": state['messages'] + [
-                                AIMessage(content=relevant_pair['answer'])
-                            ]
-                        }
-            
-            # If no match found
-            return {
-                "messages": state['messages'] + [
-                    AIMessage(content="I can only answer questions about our business operations.")
-                ]
+        # Kept async although nothing is awaited: LangGraph runs sync nodes in a thread
+        # pool under ainvoke. Errors are logged once by process_chat.
+        logger.info(f"Current state messages count: {len(state['messages'])}")
+        # Normalize case and whitespace so equivalent questions share a cache entry
+        last_message = " ".join(state['messages'][-1].content.lower().split())
+
+        answer = self._answer_cache.get(last_message)
+        if answer is None:
+            answer = self._match_answer(last_message)
+            self._answer_cache[last_message] = answer
+
+        return {
+            "messages": state['messages'] + [
+                AIMessage(content=answer, additional_kwargs={"ts": time.time()})
+            ]
+        }
+
+    def _index_knowledge_base(self) -> None:
+        """Precompute normalized QA questions, per-topic answers and the matcher."""
+        # Same normalization _call_model applies to incoming messages
+        self._qa_index = [(" ".join(pair["question"].lower().split()), pair["answer"]) for pair in self.qa_pairs]
+        self._topic_answers = {
+            topic: next((answer for question, answer in self._qa_index if topic in question), None)
+            for topic in TOPIC_KEYWORDS
+        }
+        if ahocorasick is not None:
+            self._matcher = self._build_matcher()
+        else:
+            # One alternation per topic; the lookarounds mirror the old space-padded check
+            self._topic_re = {
+                topic: re.compile(r"(?<!\S)(?:" + "|".join(re.escape(kw) for kw in keywords) + r")(?!\S)")
+                for topic, keywords in TOPIC_KEYWORDS.items()
+                if self._topic_answers[topic] is not None
             }
-        except Exception as e:
-            logger.error(f"Error in call_model: {str(e)}")
-            raise
+
+    def _build_matcher(self):
+        """Compile QA questions and topic keywords into one Aho-Corasick automaton.
+
+        Every pattern maps to ``(rank, answer)``. Exact questions rank ahead of topic
+        keywords, in QA order and then topic order, so the lowest ranked hit is the
+        answer the sequential scans used to pick.
+        """
+        patterns = {}
+        for rank, (question, answer) in enumerate(self._qa_index):
+            patterns.setdefault(question, (rank, answer))
+
+        for offset, (topic, keywords) in enumerate(TOPIC_KEYWORDS.items()):
+            answer = self._topic_answers.get(topic)
+            if answer is None:
+                continue
+            rank = len(self._qa_index) + offset
+            for kw in keywords:
+                # Padded with spaces so keywords only match whole words
+                patterns.setdefault(f" {kw} ", (rank, answer))
+
+        matcher = ahocorasick.Automaton()
+        for pattern, value in patterns.items():
+            matcher.add_word(pattern, value)
+        matcher.make_automaton()
+        return matcher
+
+    def _match_answer(self, last_message: str) -> str:
+        """Pick the knowledge base answer for a normalized user message."""
+        if self._matcher:
+            best = min((value for _, value in self._matcher.iter(f" {last_message} ")), default=None)
+            if best is not None:
+                return best[1]
+        else:
+            for question, answer in self._qa_index:
+                if question in last_message:
+                    return answer
+            for topic, pattern in self._topic_re.items():
+                if pattern.search(last_message):
+                    return self._topic_answers[topic]
+
+        # If no match found
+        return FALLBACK_ANSWER
+
+    def _unsaved_checkpoint(self, session_id: str) -> Optional[tuple]:
+        """Return the session's queued or in-flight (messages, language), newer than S3."""
+        return self._pending_checkpoints.get(session_id) or self._writing_checkpoints.get(session_id)
 
     async def get_or_create_chat_history(self, session_id: str) -> List[BaseMessage]:
         if session_id not in self.chat_histories:
+            unsaved = self._unsaved_checkpoint(session_id)
+            if unsaved is not None:
+                # Evicted before its last write reached S3; reloading from S3 would drop those turns
+                messages, language = unsaved
+                self.chat_histories[session_id] = list(messages)
+                self.chat_languages[session_id] = language
+                return self.chat_histories[session_id]
             try:
                 checkpoint = await self.memory.get(session_id)
                 if checkpoint and isinstance(checkpoint, dict) and "messages" in checkpoint:
                     self.chat_histories[session_id] = checkpoint["messages"]
+                    self.chat_languages[session_id] = checkpoint.get("language", "English")
                     logger.info(f"Loaded {len(self.chat_histories[session_id])} messages from checkpoint")
                 else:
                     logger.info(f"No existing checkpoint found for session {session_id}")
@@ -163,34 +298,84 @@ class ChatService:
         # Join paragraphs with double newline for clear separation
         return '\n\n'.join(paragraphs)
 
-    async def process_chat(self, request: ChatRequest) -> ChatResponse:
+    @asynccontextmanager
+    async def _session_lock(self, session_id: str):
+        """Hold the session's lock, dropping it once no other turn is using it."""
+        entry = self._session_locks.setdefault(session_id, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._session_locks[session_id]
+
+    async def process_chat(self, request: ChatRequest) -> Union[ChatResponse, bytes]:
         try:
             session_id = request.thread_id or self._generate_session_id(request.message)
             logger.info(f"Using session with ID: {session_id}")
             logger.info(f"Request language: {request.language}")
 
-            chat_history = await self.get_or_create_chat_history(session_id)
-            chat_history.append(HumanMessage(content=request.message))
+            # Concurrent turns of one session (double submits, client retries) must not
+            # both load the history or interleave their appends
+            async with self._session_lock(session_id):
+                chat_history = await self.get_or_create_chat_history(session_id)
+                # A new list, so the cached history stays untouched if the turn fails
+                messages = [*chat_history, HumanMessage(content=request.message, additional_kwargs={"ts": time.time()})]
 
-            config = {"configurable": {"thread_id": session_id}}
-            output = await self.workflow_app.ainvoke(
-                {"messages": chat_history, "language": request.language},
-                config=config
-            )
+                config = {"configurable": {"thread_id": session_id}}
+                output = await self.workflow_app.ainvoke(
+                    {"messages": messages, "language": request.language},
+                    config=config
+                )
 
-            if "messages" in output:
+                if "messages" not in output:
+                    raise ValueError("No response generated")
                 self.chat_histories[session_id] = output["messages"]
-                await self._save_checkpoint(session_id, output["messages"], request.language)
-                # Apply formatting to the response content before returning
-                raw_response = output["messages"][-1].content
-                formatted_response = self._format_response(raw_response)
-                return ChatResponse(response=formatted_response, language=request.language, timestamp=datetime.now())
-            else:
-                raise ValueError("No response generated")
+                self.chat_languages[session_id] = request.language
+                self._schedule_checkpoint(session_id, output["messages"], request.language)
+
+            raw_response = output["messages"][-1].content
+            if raw_response == FALLBACK_ANSWER:
+                return self._fallback_payload(request.language)
+            # Apply formatting to the response content before returning
+            formatted_response = self._format_response(raw_response)
+            return ChatResponse(response=formatted_response, language=request.language, timestamp=datetime.now())
         except Exception as e:
             logger.error(f"Error processing chat: {str(e)}")
             raise
 
+    async def process_chat_batch(self, batch: ChatBatchRequest) -> ChatBatchResponse:
+        """Process several chat requests, keeping turns of one thread in order.
+
+        Requests for different threads, and requests without a thread_id, run concurrently.
+        """
+        groups = defaultdict(list)
+        for index, request in enumerate(batch.requests):
+            # Requests without a thread_id each start their own session
+            groups[request.thread_id or f"#{index}"].append((index, request))
+
+        responses = [None] * len(batch.requests)
+
+        async def run_in_order(items):
+            for index, request in items:
+                response = await self.process_chat(request)
+                if isinstance(response, bytes):
+                    response = ChatResponse.model_validate_json(response)
+                responses[index] = response
+
+        await asyncio.gather(*(run_in_order(items) for items in groups.values()))
+        return ChatBatchResponse(responses=responses)
+
+    def _fallback_payload(self, language: str) -> bytes:
+        """Return the pre-encoded, timestamp-free response body for out-of-domain questions."""
+        payload = self._fallback_payloads.get(language)
+        if payload is None:
+            payload = orjson.dumps(ChatResponse(response=FALLBACK_ANSWER, language=language).model_dump())
+            self._fallback_payloads[language] = payload
+        return payload
+
     async def _save_checkpoint(self, session_id: str, messages: List[BaseMessage], language: str) -> None:
         try:
             await self.memory.put(
@@ -204,14 +389,60 @@ class ChatService:
             logger.error(f"Error saving checkpoint: {str(e)}")
             raise
 
+    def _schedule_checkpoint(self, session_id: str, messages: List[BaseMessage], language: str) -> None:
+        """Queue a checkpoint write, replacing any write still pending for the session."""
+        self._pending_checkpoints[session_id] = (list(messages), language)
+        self._flush_event.set()
+
+    async def _run_checkpoint_writer(self) -> None:
+        """Background task that writes queued checkpoints in coalesced batches."""
+        while True:
+            await self._flush_event.wait()
+            if not self._closing:
+                # Give further turns of the same session a chance to replace the queued write
+                await asyncio.sleep(CHECKPOINT_FLUSH_INTERVAL)
+            self._flush_event.clear()
+            await self._flush_checkpoints()
+            if self._closing:
+                return
+
+    async def _flush_checkpoints(self) -> None:
+        """Write all queued checkpoints to S3 concurrently."""
+        pending, self._pending_checkpoints = self._pending_checkpoints, {}
+        self._writing_checkpoints = pending
+        try:
+            results = await asyncio.gather(
+                *(self._save_checkpoint(session_id, messages, language)
+                  for session_id, (messages, language) in pending.items()),
+                return_exceptions=True
+            )
+        finally:
+            self._writing_checkpoints = {}
+        for (session_id, item), result in zip(pending.items(), results):
+            if isinstance(result, Exception):
+                # Retry with the next batch unless a newer state was queued meanwhile
+                self._pending_checkpoints.setdefault(session_id, item)
+
     def _generate_session_id(self, message: str) -> str:
         timestamp = datetime.now().strftime('%Y%m%d%H%M%S')
-        hash_part = format(hash(message) % (2**32), '08x')
+        # blake2b rather than hash(), which is salted per interpreter and differs across workers
+        hash_part = blake2b(message.encode('utf-8'), digest_size=4).hexdigest()
         return f"{timestamp}-{hash_part}"
 
     async def get_chat_history(self, thread_id: str) -> ChatHistoryResponse:
         try:
-            checkpoint = await self.memory.get(thread_id)
+            unsaved = self._unsaved_checkpoint(thread_id)
+            if self.chat_histories.get(thread_id):
+                # While the service is up the in-memory history is authoritative, so skip S3
+                checkpoint = {
+                    "messages": self.chat_histories[thread_id],
+                    "language": self.chat_languages.get(thread_id, "English")
+                }
+            elif unsaved is not None:
+                # Evicted from memory but S3 does not have its latest turns yet
+                checkpoint = {"messages": unsaved[0], "language": unsaved[1]}
+            else:
+                checkpoint = await self.memory.get(thread_id)
             if not checkpoint or not isinstance(checkpoint, dict) or "messages" not in checkpoint:
                 logger.info(f"No chat history found for thread {thread_id}")
                 return ChatHistoryResponse(
@@ -220,40 +451,18 @@ class ChatService:
                     language="English"
                 )
 
-            messages = []
-            # Process messages in pairs to group human and assistant interactions
-            msg_list = checkpoint["messages"]
-            for i in range(0, len(msg_list), 2):
-                # Get the human message
-                human_msg = msg_list[i]
-                if not isinstance(human_msg, HumanMessage):
-                    continue
-                
-                # Get the corresponding assistant message if it exists
-                assistant_msg = msg_list[i + 1] if i + 1 < len(msg_list) else None
-                
-                # Create timestamp for the conversation pair
-                current_time = datetime.now()
-                
-                # Add human message
-                messages.append(Message(
-                    content=human_msg.content,
-                    role="human",
-                    timestamp=current_time
-                ))
-                
-                # Add assistant message if it exists
-                if assistant_msg:
-                    messages.append(Message(
-                        content=assistant_msg.content,
-                        role="assistant",
-                        timestamp=current_time
-                    ))
+            # Messages saved before timestamps were recorded all get the current time
+            current_time = datetime.now()
+            messages = [
+                Message(content=m.content, role=MESSAGE_ROLES.get(type(m), "assistant"), timestamp=_message_time(m, current_time))
+                for m in checkpoint["messages"]
+                if isinstance(m, BaseMessage)
+            ]
 
             return ChatHistoryResponse(
                 thread_id=thread_id,
                 messages=messages,
-                language=checkpoint.get("metadata", {}).get("language", "English")
+                language=checkpoint.get("language", "English")
             )
         except Exception as e:
             logger.error(f"Error retrieving chat history for thread {thread_id}: {str(e)}")
@@ -1,31 +1,61 @@
-import json
+import asyncio
 import logging
 import aioboto3
+import orjson
+import zstandard as zstd
 from datetime import datetime
-from typing import Any, Dict, Optional
+from typing import Any, Dict, List, Optional
 from langchain_core.messages import BaseMessage, HumanMessage, AIMessage
 from botocore.exceptions import ClientError
+from cachetools import LRUCache
 from langgraph.checkpoint.memory import MemorySaver
 
 logger = logging.getLogger(__name__)
 
-class MessageEncoder(json.JSONEncoder):
-    """Custom JSON encoder for LangChain message objects."""
-    def default(self, obj):
-        if isinstance(obj, BaseMessage):
-            return {
-                '_type': obj.__class__.__name__,
-                'content': obj.content,
-                'additional_kwargs': obj.additional_kwargs,
-                'type': obj.type
-            }
-        return super().default(obj)
+# Objects larger than this are downloaded as parallel ranged GETs of this size
+RANGE_CHUNK_SIZE = 1 << 20
+
+# History JSON repeats the same keys for every message and compresses well
+_compressor = zstd.ZstdCompressor(level=3)
+_decompressor = zstd.ZstdDecompressor()
+
+def _encode_message(obj: Any) -> Dict[str, Any]:
+    """orjson ``default`` hook for LangChain message objects."""
+    if isinstance(obj, BaseMessage):
+        return {
+            '_type': obj.__class__.__name__,
+            'content': obj.content,
+            'additional_kwargs': obj.additional_kwargs,
+            'type': obj.type
+        }
+    raise TypeError(f"Object of type {obj.__class__.__name__} is not JSON serializable")
+
+def _copy_state(state: Dict[str, Any]) -> Dict[str, Any]:
+    """Copy the top-level containers of a cached state so callers can append to them."""
+    return {k: list(v) if isinstance(v, list) else v for k, v in state.items()}
+
+def _decode_message(data: Any) -> Any:
+    """Rebuild a LangChain message from its serialized form."""
+    if isinstance(data, dict):
+        msg_type = data.get('_type')
+        if msg_type == 'HumanMessage':
+            return HumanMessage(content=data['content'], additional_kwargs=data['additional_kwargs'])
+        elif msg_type == 'AIMessage':
+            return AIMessage(content=data['content'], additional_kwargs=data['additional_kwargs'])
+    return data
 
 class S3MemorySaver(MemorySaver):
-    """A memory saver that uses S3 as the backend storage."""
+    """A memory saver that uses S3 as the backend storage.
+
+    Each session is an append-only log: every ``put`` writes only the messages added
+    since the previous write to ``chat_histories/{session_id}/turn-{n:06d}.json``.
+    Histories saved as a single ``chat_histories/{session_id}.json`` object by
+    earlier versions are still read and used as the start of the log.
+    """
 
     def __init__(self, bucket_name: str, aws_access_key_id: Optional[str] = None,
-                 aws_secret_access_key: Optional[str] = None, region_name: Optional[str] = None):
+                 aws_secret_access_key: Optional[str] = None, region_name: Optional[str] = None,
+                 s3_client: Optional[Any] = None, cache_size: int = 1024, max_concurrency: int = 8):
         """Initialize the S3 memory saver.
 
         Args:
@@ -33,87 +63,205 @@ class S3MemorySaver(MemorySaver):
             aws_access_key_id: AWS access key ID (optional if using IAM roles)
             aws_secret_access_key: AWS secret access key (optional if using IAM roles)
             region_name: AWS region name (optional, defaults to boto3's default region)
+            s3_client: Already-opened aioboto3 S3 client to share (optional, one is
+                created on first use otherwise and released by ``close``)
+            cache_size: Number of sessions whose assembled history is kept in memory
+            max_concurrency: Maximum number of GET requests in flight at once
         """
         super().__init__()
         self.bucket_name = bucket_name
         self.aws_access_key_id = aws_access_key_id
         self.aws_secret_access_key = aws_secret_access_key
         self.region_name = region_name
-        self.session = aioboto3.Session()
-
-    def _deserialize_messages(self, data: Dict[str, Any]) -> Dict[str, Any]:
-        """Deserialize message objects from JSON data."""
-        if isinstance(data, dict):
-            if '_type' in data:
-                msg_type = data['_type']
-                if msg_type == 'HumanMessage':
-                    return HumanMessage(content=data['content'], additional_kwargs=data['additional_kwargs'])
-                elif msg_type == 'AIMessage':
-                    return AIMessage(content=data['content'], additional_kwargs=data['additional_kwargs'])
-            return {k: self._deserialize_messages(v) for k, v in data.items()}
-        elif isinstance(data, list):
-            return [self._deserialize_messages(item) for item in data]
-        return data
-
-    def _get_s3_key(self, session_id: str) -> str:
-        """Generate the S3 key for a given session ID."""
-        return f"chat_histories/{session_id}.json"
+        self.s3_client = s3_client
+        self._s3_client_ctx = None
+        # session_id -> assembled state plus the next turn number to read or write
+        self._histories = LRUCache(maxsize=cache_size)
+        self._read_slots = asyncio.Semaphore(max_concurrency)
 
-    async def get(self, session_id: str) -> Optional[Dict[str, Any]]:
-        """Retrieve chat history from S3 by session ID."""
-        try:
-            async with self.session.client(
+    async def _get_client(self):
+        """Return the long-lived S3 client, opening it on first use."""
+        if self.s3_client is None:
+            self._s3_client_ctx = aioboto3.Session().client(
                 's3',
                 aws_access_key_id=self.aws_access_key_id,
                 aws_secret_access_key=self.aws_secret_access_key,
                 region_name=self.region_name
-            ) as s3_client:
-                s3_key = self._get_s3_key(session_id)
-                response = await s3_client.get_object(Bucket=self.bucket_name, Key=s3_key)
-                async with response['Body'] as stream:
-                    content = await stream.read()
-                    data = json.loads(content.decode('utf-8'))
-                    if 'state' in data:
-                        return self._deserialize_messages(data['state'])
-                    return self._deserialize_messages(data)
+            )
+            self.s3_client = await self._s3_client_ctx.__aenter__()
+        return self.s3_client
+
+    async def close(self) -> None:
+        """Close the S3 client if it was opened by this saver."""
+        if self._s3_client_ctx is not None:
+            await self._s3_client_ctx.__aexit__(None, None, None)
+            self._s3_client_ctx = None
+            self.s3_client = None
+
+    def _get_s3_key(self, session_id: str) -> str:
+        """Generate the S3 key of the legacy single-object history for a session ID."""
+        return f"chat_histories/{session_id}.json"
+
+    def _get_turn_prefix(self, session_id: str) -> str:
+        """Generate the S3 prefix holding the turn objects of a session ID."""
+        return f"chat_histories/{session_id}/"
+
+    def _get_turn_key(self, session_id: str, turn: int) -> str:
+        """Generate the S3 key of a single turn object."""
+        return f"{self._get_turn_prefix(session_id)}turn-{turn:06d}.json"
+
+    def _get_history(self, session_id: str) -> Dict[str, Any]:
+        """Return the in-memory history entry for a session, creating it if needed."""
+        history = self._histories.get(session_id)
+        if history is None:
+            history = {'state': None, 'next_turn': 0, 'loaded': False, 'lock': asyncio.Lock()}
+            self._histories[session_id] = history
+        return history
+
+    async def _get_range(self, s3_client, s3_key: str, first: int, last: int, **params):
+        """Download one byte range of an object, returning the response and its bytes."""
+        async with self._read_slots:
+            response = await s3_client.get_object(Bucket=self.bucket_name, Key=s3_key, Range=f"bytes={first}-{last}", **params)
+            async with response['Body'] as stream:
+                return response, await stream.read()
+
+    async def _read_object(self, s3_client, s3_key: str) -> bytes:
+        """Download and decompress an object, fetching anything past the first chunk with parallel ranged GETs."""
+        response, content = await self._get_range(s3_client, s3_key, 0, RANGE_CHUNK_SIZE - 1)
+        # ContentRange looks like "bytes 0-1048575/5242880"
+        content_range = response.get('ContentRange')
+        total_size = int(content_range.rsplit('/', 1)[1]) if content_range else len(content)
+        if total_size > len(content):
+            # IfMatch makes S3 fail the read rather than splice ranges from an overwritten object
+            parts = await asyncio.gather(*(
+                self._get_range(s3_client, s3_key, first, min(first + RANGE_CHUNK_SIZE, total_size) - 1,
+                                IfMatch=response['ETag'])
+                for first in range(len(content), total_size, RANGE_CHUNK_SIZE)
+            ))
+            content += b''.join(part for _, part in parts)
+
+        # Objects written before compression was introduced have no ContentEncoding
+        if response.get('ContentEncoding') == 'zstd':
+            content = _decompressor.decompress(content)
+        return content
+
+    async def _read_state(self, s3_client, s3_key: str) -> Optional[Dict[str, Any]]:
+        """Download one history object and decode its state, or None if it does not exist."""
+        try:
+            content = await self._read_object(s3_client, s3_key)
         except ClientError as e:
             if e.response['Error']['Code'] == 'NoSuchKey':
-                logger.info(f"No chat history found for session {session_id}")
                 return None
+            raise
+        data = orjson.loads(content)
+        state = data.get('state', data)
+        # Messages only ever live under state["messages"], so decode just that list
+        if isinstance(state.get('messages'), list):
+            state['messages'] = [_decode_message(m) for m in state['messages']]
+        return state
+
+    async def _list_turn_keys(self, s3_client, session_id: str, start_after: Optional[str] = None) -> List[str]:
+        """List the turn object keys of a session in turn order."""
+        paginator = s3_client.get_paginator('list_objects_v2')
+        params = {'Bucket': self.bucket_name, 'Prefix': self._get_turn_prefix(session_id)}
+        if start_after:
+            params['StartAfter'] = start_after
+        keys = []
+        async for page in paginator.paginate(**params):
+            keys.extend(obj['Key'] for obj in page.get('Contents', []))
+        return keys
+
+    def _apply_turn(self, history: Dict[str, Any], state: Dict[str, Any]) -> None:
+        """Append a turn's messages to the assembled state and take its other fields."""
+        if history['state'] is None:
+            history['state'] = {'messages': []}
+        for key, value in state.items():
+            if key == 'messages':
+                history['state'].setdefault('messages', []).extend(value)
             else:
-                logger.error(f"Error retrieving chat history from S3: {str(e)}")
-                raise
+                history['state'][key] = value
+
+    async def _refresh(self, s3_client, session_id: str, history: Dict[str, Any]) -> None:
+        """Bring a history entry up to date by reading only turns it has not seen yet."""
+        if not history['loaded']:
+            legacy_state = await self._read_state(s3_client, self._get_s3_key(session_id))
+            if legacy_state is not None:
+                self._apply_turn(history, legacy_state)
+            history['loaded'] = True
+
+        start_after = None
+        if history['next_turn']:
+            start_after = self._get_turn_key(session_id, history['next_turn'] - 1)
+        turn_keys = await self._list_turn_keys(s3_client, session_id, start_after)
+        # Fetch the new turns concurrently; gather keeps them in turn order
+        states = await asyncio.gather(*(self._read_state(s3_client, s3_key) for s3_key in turn_keys))
+        for s3_key, state in zip(turn_keys, states):
+            if state is not None:
+                self._apply_turn(history, state)
+            history['next_turn'] = int(s3_key.rsplit('turn-', 1)[1].split('.', 1)[0]) + 1
+
+    async def get(self, session_id: str) -> Optional[Dict[str, Any]]:
+        """Retrieve chat history from S3 by session ID."""
+        try:
+            s3_client = await self._get_client()
+            history = self._get_history(session_id)
+            async with history['lock']:
+                await self._refresh(s3_client, session_id, history)
+                if history['state'] is None:
+                    logger.info(f"No chat history found for session {session_id}")
+                    return None
+                return _copy_state(history['state'])
+        except ClientError as e:
+            logger.error(f"Error retrieving chat history from S3: {str(e)}")
+            raise
 
     async def put(self, session_id: str, data: Any, metadata: Optional[Dict] = None, new_versions: Optional[Dict] = None) -> None:
-        """Save chat history to S3.
+        """Save chat history to S3 by appending the messages not yet stored as a new turn.
 
         Args:
             session_id: The unique session identifier
-            data: The data to save
+            data: The data to save, holding the full message list under "messages"
             metadata: Optional metadata to save with the state
             new_versions: Optional version information
         """
         try:
-            async with self.session.client(
-                's3',
-                aws_access_key_id=self.aws_access_key_id,
-                aws_secret_access_key=self.aws_secret_access_key,
-                region_name=self.region_name
-            ) as s3_client:
-                s3_key = self._get_s3_key(session_id)
+            s3_client = await self._get_client()
+            history = self._get_history(session_id)
+            async with history['lock']:
+                if not history['loaded']:
+                    await self._refresh(s3_client, session_id, history)
+
+                stored_count = len((history['state'] or {}).get('messages', []))
+                messages = data.get('messages', [])
+                if len(messages) < stored_count:
+                    # Only a suffix is ever written, so a shorter list cannot be stored as a turn
+                    raise ValueError(
+                        f"Session {session_id} has {stored_count} stored messages but put() "
+                        f"received {len(messages)}; the history must only grow"
+                    )
+                new_messages = messages[stored_count:]
+                if not new_messages:
+                    logger.info(f"No new messages to save for session {session_id}")
+                    return
+
+                turn = history['next_turn']
+                turn_state = {**data, 'messages': new_messages}
                 save_data = {
-                    'state': data,
+                    'state': turn_state,
                     'metadata': metadata or {},
                     'new_versions': new_versions or {},
                     'last_updated': datetime.now().isoformat()
                 }
                 await s3_client.put_object(
                     Bucket=self.bucket_name,
-                    Key=s3_key,
-                    Body=json.dumps(save_data, cls=MessageEncoder),
-                    ContentType='application/json'
+                    Key=self._get_turn_key(session_id, turn),
+                    Body=_compressor.compress(orjson.dumps(save_data, default=_encode_message)),
+                    ContentType='application/json',
+                    ContentEncoding='zstd'
                 )
-                logger.info(f"Successfully saved chat history to S3 for session {session_id}")
+                self._apply_turn(history, turn_state)
+                history['next_turn'] = turn + 1
+            logger.info(f"Successfully saved chat history to S3 for session {session_id}")
         except Exception as e:
             logger.error(f"Error saving chat history to S3: {str(e)}")
             raise
@@ -121,38 +269,48 @@ class S3MemorySaver(MemorySaver):
     async def cleanup_old_sessions(self, max_age_days: int = 30) -> None:
         """Clean up old chat histories from S3.
 
+        A session is removed only when its most recent object is older than the limit,
+        so old turns of a conversation that is still active are kept.
+
         Args:
             max_age_days: Maximum age of chat histories to keep (in days)
         """
         try:
-            async with self.session.client(
-                's3',
-                aws_access_key_id=self.aws_access_key_id,
-                aws_secret_access_key=self.aws_secret_access_key,
-                region_name=self.region_name
-            ) as s3_client:
-                paginator = s3_client.get_paginator('list_objects_v2')
-                current_time = datetime.now()
-                
-                async for page in paginator.paginate(Bucket=self.bucket_name, Prefix='chat_histories/'):
-                    if 'Contents' not in page:
+            s3_client = await self._get_client()
+            paginator = s3_client.get_paginator('list_objects_v2')
+            current_time = datetime.now()
+            # session_id -> (newest LastModified, keys)
+            sessions = {}
+            
+            async for page in paginator.paginate(Bucket=self.bucket_name, Prefix='chat_histories/'):
+                if 'Contents' not in page:
+                    continue
+                    
+                for obj in page['Contents']:
+                    # Skip if not a chat history file
+                    if not obj['Key'].endswith('.json'):
                         continue
+
+                    name = obj['Key'][len('chat_histories/'):]
+                    session_id = name.split('/', 1)[0] if '/' in name else name[:-len('.json')]
+                    last_modified = obj['LastModified'].replace(tzinfo=None)
+                    newest, keys = sessions.get(session_id, (last_modified, []))
+                    keys.append(obj['Key'])
+                    sessions[session_id] = (max(newest, last_modified), keys)
+
+            for session_id, (newest, keys) in sessions.items():
+                # Check if the session is older than max_age_days
+                age = (current_time - newest).days
+                if age > max_age_days:
+                    for key in keys:
+                        await s3_client.delete_object(
+                            Bucket=self.bucket_name,
+                            Key=key
+                        )
+                    self._histories.pop(session_id, None)
+                    logger.info(f"Deleted old chat history: {session_id}")
                         
-                    for obj in page['Contents']:
-                        # Skip if not a chat history file
-                        if not obj['Key'].endswith('.json'):
-                            continue
-                            
-                        # Check if file is older than max_age_days
-                        age = (current_time - obj['LastModified'].replace(tzinfo=None)).days
-                        if age > max_age_days:
-                            await s3_client.delete_object(
-                                Bucket=self.bucket_name,
-                                Key=obj['Key']
-                            )
-                            logger.info(f"Deleted old chat history: {obj['Key']}")
-                            
-                logger.info("Completed cleanup of old chat histories")
+            logger.info("Completed cleanup of old chat histories")
         except Exception as e:
             logger.error(f"Error during cleanup of old chat histories: {str(e)}")
             raise
\ No newline at end of file
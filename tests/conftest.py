@@ -0,0 +1,36 @@
+import os
+import asyncio
+import pytest
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import uvloop
+except ImportError:  # installed with uvicorn[standard], but not available on Windows
+    uvloop = None
+
+# Blocking work handed to the loop's executor (DNS lookups by the S3 client, sync SDK calls)
+# is I/O bound, so allow more threads than the default min(32, cpu_count + 4)
+EXECUTOR_WORKERS = (os.cpu_count() or 4) * 5
+
+class _TestEventLoopPolicy(uvloop.EventLoopPolicy if uvloop is not None else asyncio.DefaultEventLoopPolicy):
+    def new_event_loop(self):
+        loop = super().new_event_loop()
+        # Shut down by loop.close() along with the loop
+        loop.set_default_executor(ThreadPoolExecutor(max_workers=EXECUTOR_WORKERS, thread_name_prefix="test-io"))
+        return loop
+
+@pytest.fixture(scope="session")
+def event_loop_policy():
+    # Run the async tests on the same loop implementation the server uses
+    return _TestEventLoopPolicy()
+
+def pytest_addoption(parser):
+    parser.addoption("--run-e2e", action="store_true", default=False, help="run tests marked e2e")
+
+def pytest_collection_modifyitems(config, items):
+    if config.getoption("--run-e2e"):
+        return
+    skip_e2e = pytest.mark.skip(reason="end-to-end test; run with --run-e2e")
+    for item in items:
+        if "e2e" in item.keywords:
+            item.add_marker(skip_e2e)
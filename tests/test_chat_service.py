@@ -1,9 +1,13 @@
+import asyncio
+import orjson
 import pytest
-from unittest.mock import Mock, patch
+from cachetools import LRUCache
+from unittest.mock import AsyncMock, Mock, patch
 from datetime import datetime
 from langchain_core.messages import HumanMessage, AIMessage
-from src.services.chat_service import ChatService
-from src.models.chat import ChatRequest, ChatResponse
+from src.services import chat_service as chat_service_module
+from src.services.chat_service import ChatService, FALLBACK_ANSWER
+from src.models.chat import ChatRequest, ChatResponse, ChatBatchRequest
 
 @pytest.fixture
 def chat_service():
@@ -42,6 +46,92 @@ async def test_process_chat_success(chat_service, mock_memory, mock_llm):
     assert response.language == "English"
     assert isinstance(response.timestamp, datetime)
 
+@pytest.mark.asyncio
+async def test_process_chat_reuses_fallback_response(chat_service):
+    # Arrange
+    chat_service.memory = AsyncMock()
+    chat_service.memory.get.return_value = None
+    chat_service.workflow_app = AsyncMock()
+    chat_service.workflow_app.ainvoke.return_value = {
+        "messages": [HumanMessage(content="Tell me a joke"), AIMessage(content=FALLBACK_ANSWER)]
+    }
+    request = ChatRequest(message="Tell me a joke", language="English")
+
+    # Act
+    first = await chat_service.process_chat(request)
+    second = await chat_service.process_chat(request)
+
+    # Assert
+    assert first is second
+    assert orjson.loads(first) == {"response": FALLBACK_ANSWER, "language": "English", "timestamp": None}
+
+@pytest.mark.asyncio
+async def test_process_chat_serializes_concurrent_turns_of_a_session(chat_service):
+    # Arrange
+    async def slow_get(session_id):
+        await asyncio.sleep(0)
+        return None
+
+    chat_service.memory = Mock()
+    chat_service.memory.get = AsyncMock(side_effect=slow_get)
+    chat_service.workflow_app = AsyncMock()
+    chat_service.workflow_app.ainvoke.side_effect = lambda inputs, config: {
+        "messages": inputs["messages"] + [AIMessage(content="Hi there!")]
+    }
+    request = ChatRequest(message="Hello", language="English", thread_id="test-session")
+
+    # Act
+    await asyncio.gather(chat_service.process_chat(request), chat_service.process_chat(request))
+
+    # Assert
+    chat_service.memory.get.assert_awaited_once()
+    assert [m.content for m in chat_service.chat_histories["test-session"]] == ["Hello", "Hi there!"] * 2
+    assert not chat_service._session_locks
+
+@pytest.mark.asyncio
+async def test_process_chat_batch_keeps_thread_order(chat_service):
+    # Arrange
+    order = []
+
+    async def fake_process_chat(request):
+        await asyncio.sleep(0.01 if request.message == "first" else 0)
+        order.append(request.message)
+        if request.message == "joke":
+            return chat_service._fallback_payload(request.language)
+        return ChatResponse(response=request.message.upper(), language=request.language)
+
+    chat_service.process_chat = fake_process_chat
+    batch = ChatBatchRequest(requests=[
+        ChatRequest(message="first", thread_id="test-session"),
+        ChatRequest(message="joke"),
+        ChatRequest(message="second", thread_id="test-session"),
+    ])
+
+    # Act
+    result = await chat_service.process_chat_batch(batch)
+
+    # Assert
+    assert [r.response for r in result.responses] == ["FIRST", FALLBACK_ANSWER, "SECOND"]
+    assert order.index("first") < order.index("second")
+    assert order[0] == "joke"
+
+@pytest.mark.asyncio
+async def test_process_chat_failure_leaves_cached_history_unchanged(chat_service):
+    # Arrange
+    history = [HumanMessage(content="Hello"), AIMessage(content="Hi there!")]
+    chat_service.chat_histories["test-session"] = history
+    chat_service.workflow_app = AsyncMock()
+    chat_service.workflow_app.ainvoke.side_effect = Exception("model unavailable")
+    request = ChatRequest(message="Bye", language="English", thread_id="test-session")
+
+    # Act
+    with pytest.raises(Exception):
+        await chat_service.process_chat(request)
+
+    # Assert
+    assert chat_service.chat_histories["test-session"] is history
+    assert [m.content for m in history] == ["Hello", "Hi there!"]
+
 @pytest.mark.asyncio
 async def test_get_or_create_chat_history_new_session(chat_service, mock_memory):
     # Arrange
@@ -90,6 +180,107 @@ async def test_save_checkpoint(chat_service, mock_memory):
     assert call_args[0] == session_id
     assert call_args[1]["messages"] == messages
 
+@pytest.mark.asyncio
+async def test_process_chat_keeps_queued_turns_of_an_evicted_session(chat_service):
+    # Arrange
+    chat_service.chat_histories = LRUCache(maxsize=2)
+    chat_service.chat_languages = LRUCache(maxsize=2)
+    chat_service.memory = AsyncMock()
+    chat_service.memory.get.return_value = None
+    chat_service.workflow_app = AsyncMock()
+    chat_service.workflow_app.ainvoke.side_effect = lambda inputs, config: {
+        "messages": inputs["messages"] + [AIMessage(content=inputs["messages"][-1].content.upper())]
+    }
+
+    async def turn(message, thread_id="test-session"):
+        await chat_service.process_chat(ChatRequest(message=message, thread_id=thread_id))
+
+    await turn("one")
+    await chat_service._flush_checkpoints()
+    # S3 now only has the first turn
+    chat_service.memory.get.return_value = {"messages": chat_service.memory.put.await_args.args[1]["messages"]}
+    await turn("two")  # still queued, not flushed
+    await turn("other", thread_id="other-session")
+    await turn("another", thread_id="another-session")
+    assert "test-session" not in chat_service.chat_histories
+
+    # Act
+    await turn("three")
+
+    # Assert
+    expected = ["one", "ONE", "two", "TWO", "three", "THREE"]
+    assert [m.content for m in chat_service.chat_histories["test-session"]] == expected
+    assert [m.content for m in chat_service._pending_checkpoints["test-session"][0]] == expected
+
+@pytest.mark.asyncio
+async def test_flush_checkpoints_coalesces_writes_per_session(chat_service):
+    # Arrange
+    chat_service.memory = AsyncMock()
+    first_turn = [HumanMessage(content="Hello"), AIMessage(content="Hi there!")]
+    second_turn = first_turn + [HumanMessage(content="Bye"), AIMessage(content="Goodbye!")]
+    chat_service._schedule_checkpoint("test-session", first_turn, "English")
+    chat_service._schedule_checkpoint("test-session", second_turn, "English")
+    chat_service._schedule_checkpoint("other-session", first_turn, "English")
+
+    # Act
+    await chat_service._flush_checkpoints()
+
+    # Assert
+    assert chat_service.memory.put.await_count == 2
+    saved = {call.args[0]: call.args[1]["messages"] for call in chat_service.memory.put.await_args_list}
+    assert saved["test-session"] == second_turn
+    assert not chat_service._pending_checkpoints
+
+@pytest.mark.asyncio
+async def test_close_retries_checkpoints_that_failed_to_save(chat_service):
+    # Arrange
+    chat_service.memory = AsyncMock()
+    chat_service.memory.put.side_effect = [Exception("S3 unavailable"), None]
+    chat_service._checkpoint_writer_task = asyncio.create_task(chat_service._run_checkpoint_writer())
+    chat_service._schedule_checkpoint("test-session", [HumanMessage(content="Hello")], "English")
+
+    # Act
+    await chat_service.close()
+
+    # Assert
+    assert chat_service.memory.put.await_count == 2
+    assert not chat_service._pending_checkpoints
+
+@pytest.mark.asyncio
+async def test_get_chat_history_keeps_unpaired_messages(chat_service):
+    # Arrange
+    chat_service.memory = AsyncMock()
+    chat_service.memory.get.return_value = {
+        "messages": [
+            HumanMessage(content="Hello", additional_kwargs={"ts": 1700000000.0}),
+            AIMessage(content="Hi there!"),
+            HumanMessage(content="Bye")
+        ]
+    }
+
+    # Act
+    history = await chat_service.get_chat_history("test-session")
+
+    # Assert
+    assert [m.role for m in history.messages] == ["human", "assistant", "human"]
+    assert history.messages[-1].content == "Bye"
+    assert history.messages[0].timestamp == datetime.fromtimestamp(1700000000.0)
+
+@pytest.mark.asyncio
+async def test_get_chat_history_serves_warm_session_from_memory(chat_service):
+    # Arrange
+    chat_service.memory = AsyncMock()
+    chat_service.chat_histories["test-session"] = [HumanMessage(content="Hola"), AIMessage(content="Hola!")]
+    chat_service.chat_languages["test-session"] = "Spanish"
+
+    # Act
+    history = await chat_service.get_chat_history("test-session")
+
+    # Assert
+    chat_service.memory.get.assert_not_awaited()
+    assert len(history.messages) == 2
+    assert history.language == "Spanish"
+
 def test_generate_session_id(chat_service):
     # Arrange
     message = "test message"
@@ -101,4 +292,53 @@ def test_generate_session_id(chat_service):
     assert isinstance(session_id, str)
     assert "-" in session_id
     timestamp, hash_part = session_id.split("-")
-    assert len(hash_part) == 8
\ No newline at end of file
+    assert len(hash_part) == 8
+
+def test_generate_session_id_hash_is_stable(chat_service):
+    # Same message must hash identically in every worker process
+    hash_part = chat_service._generate_session_id("test message").split("-")[1]
+    assert hash_part == "d153eefb"
+
+@pytest.mark.asyncio
+async def test_call_model_reuses_cached_answer(chat_service):
+    # Arrange
+    chat_service.qa_pairs = [{"question": "What are your business hours?", "answer": "9am to 5pm."}]
+    first = {"messages": [HumanMessage(content="What are your business hours?")]}
+    repeat = {"messages": [HumanMessage(content="  what are your   BUSINESS hours? ")]}
+    chat_service._index_knowledge_base()
+
+    # Act
+    await chat_service._call_model(first, {})
+    chat_service._match_answer = Mock(side_effect=AssertionError("answer should come from the cache"))
+    result = await chat_service._call_model(repeat, {})
+
+    # Assert
+    assert result["messages"][-1].content == "9am to 5pm."
+
+
+@pytest.mark.parametrize("use_automaton", [True, False])
+def test_match_answer_prefers_exact_question_over_topic_keyword(chat_service, monkeypatch, use_automaton):
+    # Arrange
+    if not use_automaton:
+        monkeypatch.setattr(chat_service_module, "ahocorasick", None)
+    chat_service.qa_pairs = [
+        {"question": "How does password reset work?", "answer": "Use the reset link."},
+        {"question": "What are your business hours?", "answer": "9am to 5pm."},
+    ]
+    chat_service._index_knowledge_base()
+
+    # Act / Assert
+    assert chat_service._match_answer("i forgot what are your business hours?") == "9am to 5pm."
+    assert chat_service._match_answer("i forgot my password") == "Use the reset link."
+    assert chat_service._match_answer("tell me a joke") == "I can only answer questions about our business operations."
+
+
+def test_index_knowledge_base_normalizes_question_whitespace(chat_service):
+    # Arrange
+    chat_service.qa_pairs = [{"question": "What  are your\tbusiness hours? ", "answer": "9am to 5pm."}]
+
+    # Act
+    chat_service._index_knowledge_base()
+
+    # Assert
+    assert chat_service._match_answer("what are your business hours?") == "9am to 5pm."
@@ -1,94 +1,158 @@
+import os
+import time
+import asyncio
+import statistics
+import orjson
 import pytest
-from fastapi.testclient import TestClient
+from httpx import ASGITransport, AsyncClient, Limits
 from datetime import datetime
-from src.models.chat import ChatRequest, ChatResponse
-from app import app
+from pathlib import Path
+from src.config.settings import MAX_BATCH_SIZE
+from src.models.chat import ChatResponse, ChatBatchResponse
+from starlette.middleware.base import BaseHTTPMiddleware
+from main import app, get_chat_service
 
-@pytest.fixture
-def client():
-    return TestClient(app)
+# Every test and the module-scoped client share one event loop
+pytestmark = [pytest.mark.e2e, pytest.mark.asyncio(scope="module")]
 
-def test_chat_endpoint_success(client):
-    # Arrange
-    request_data = {
+# Under pytest-xdist each worker is its own process with its own app; suffix thread ids
+# with the worker name so concurrent workers never share a conversation
+WORKER_ID = os.environ.get("PYTEST_XDIST_WORKER", "main")
+
+# Set to run the tests against a running server (e.g. http://localhost:8000) instead of in-process
+E2E_BASE_URL = os.environ.get("E2E_BASE_URL")
+
+# Request bodies encoded once with orjson instead of by httpx's json= on every post
+JSON_HEADERS = {"content-type": "application/json"}
+HELLO_ENGLISH = orjson.dumps({"message": "Hello", "language": "English"})
+HELLO_IN_THREAD = orjson.dumps({"message": "Hello", "language": "English", "thread_id": f"test-thread-{WORKER_ID}"})
+HELLO_NO_LANGUAGE = orjson.dumps({"message": "Hello", "language": ""})
+EMPTY_REQUEST = orjson.dumps({})
+OVERSIZED_BATCH = orjson.dumps({"requests": [{"message": "Hello"}] * (MAX_BATCH_SIZE + 1)})
+CONVERSATION_BATCH = orjson.dumps({"requests": [
+    {
         "message": "Hello",
-        "language": "English"
+        "language": "English",
+        "thread_id": f"test-conversation-{WORKER_ID}"
+    },
+    {
+        "message": "How are you?",
+        "language": "English",
+        "thread_id": f"test-conversation-{WORKER_ID}"
     }
+]})
 
-    # Act
-    response = client.post("/chat", json=request_data)
+PERF_REQUESTS = 20
+# Without a thread_id the server derives one session id from the current second and the message,
+# so give every timed request its own thread instead of queuing them all on one session lock
+PERF_PAYLOADS = [
+    orjson.dumps({"message": "Hello", "language": "English", "thread_id": f"test-perf-{WORKER_ID}-{i}"})
+    for i in range(PERF_REQUESTS)
+]
+WARM_UP = orjson.dumps({"message": "Hello", "language": "English", "thread_id": f"test-warm-up-{WORKER_ID}"})
+if E2E_BASE_URL:
+    # A real server reads and writes S3, so only hold it to the service-level budget
+    PERF_P95_BUDGET_US = 5_000_000
+    SERVER_TIME_P95_BUDGET_MS = 3_000
+else:
+    # The service is faked, so these bound routing, validation and serialization only
+    PERF_P95_BUDGET_US = 500_000
+    # Server-side time from the X-Response-Time header, excluding the client
+    SERVER_TIME_P95_BUDGET_MS = 100
 
-    # Assert
+class FakeChatService:
+    """Answers instantly so these tests exercise the API layer, not the model or S3."""
+
+    async def process_chat(self, request):
+        return ChatResponse(response="ok", language=request.language or "English", timestamp=datetime.now())
+
+    async def process_chat_batch(self, batch):
+        return ChatBatchResponse(responses=[await self.process_chat(request) for request in batch.requests])
+
+@pytest.fixture(scope="module")
+async def client():
+    if E2E_BASE_URL:
+        # One keep-alive pool for the whole module, large enough for the concurrent performance test
+        limits = Limits(max_connections=PERF_REQUESTS, max_keepalive_connections=PERF_REQUESTS)
+        async with AsyncClient(base_url=E2E_BASE_URL, limits=limits) as c:
+            yield c
+        return
+
+    # With the service overridden there is nothing for the lifespan to start
+    app.dependency_overrides[get_chat_service] = FakeChatService
+    try:
+        async with AsyncClient(transport=ASGITransport(app=app), base_url="http://testserver") as c:
+            yield c
+    finally:
+        app.dependency_overrides.clear()
+
+@pytest.fixture(scope="module", autouse=True)
+async def warm_up(client):
+    # Pay first-request costs (validator and serializer setup, route resolution) outside the tests
+    response = await client.post("/chat", content=WARM_UP, headers=JSON_HEADERS)
     assert response.status_code == 200
-    response_data = response.json()
-    assert "response" in response_data
-    assert "language" in response_data
-    assert response_data["language"] == "English"
 
-def test_chat_endpoint_with_thread_id(client):
-    # Arrange
-    request_data = {
-        "message": "Hello",
-        "language": "English",
-        "thread_id": "test-thread"
-    }
+async def test_app_middleware_is_pure_asgi():
+    # BaseHTTPMiddleware costs a task and a body stream per request; keep it out of the stack
+    assert not any(issubclass(middleware.cls, BaseHTTPMiddleware) for middleware in app.user_middleware)
 
+@pytest.mark.parametrize("payload", [HELLO_ENGLISH, HELLO_IN_THREAD], ids=["new_session", "with_thread_id"])
+async def test_chat_endpoint_success(client, payload):
     # Act
-    response = client.post("/chat", json=request_data)
+    response = await client.post("/chat", content=payload, headers=JSON_HEADERS)
 
     # Assert
     assert response.status_code == 200
-    response_data = response.json()
+    response_data = orjson.loads(response.content)
     assert "response" in response_data
+    assert "language" in response_data
+    assert response_data["language"] == "English"
 
-def test_chat_endpoint_conversation_flow(client):
-    # Test a complete conversation flow with multiple messages
-    # First message
-    response1 = client.post("/chat", json={
-        "message": "Hello",
-        "language": "English",
-        "thread_id": "test-conversation"
-    })
-    assert response1.status_code == 200
-    thread_response1 = response1.json()
-
-    # Second message in same thread
-    response2 = client.post("/chat", json={
-        "message": "How are you?",
-        "language": "English",
-        "thread_id": "test-conversation"
-    })
-    assert response2.status_code == 200
-    thread_response2 = response2.json()
+async def test_chat_endpoint_conversation_flow(client):
+    # Test a complete conversation flow with multiple messages in one batch;
+    # turns of the same thread are answered in order
+    response = await client.post("/chat/batch", content=CONVERSATION_BATCH, headers=JSON_HEADERS)
+    assert response.status_code == 200
+    thread_response1, thread_response2 = orjson.loads(response.content)["responses"]
 
     # Verify both responses are valid
     assert "response" in thread_response1
     assert "response" in thread_response2
 
-def test_chat_endpoint_error_handling(client):
-    # Test with invalid request data
-    response = client.post("/chat", json={})
-    assert response.status_code == 422  # Validation error
+async def test_chat_batch_endpoint_rejects_oversized_batch(client):
+    response = await client.post("/chat/batch", content=OVERSIZED_BATCH, headers=JSON_HEADERS)
+    assert response.status_code == 422
 
-    # Test with invalid language
-    response = client.post("/chat", json={
-        "message": "Hello",
-        "language": ""
-    })
-    assert response.status_code == 200  # Should default to English
-
-def test_chat_endpoint_performance(client):
-    # Test response time for a simple request
-    import time
-    start_time = time.time()
-    
-    response = client.post("/chat", json={
-        "message": "Hello",
-        "language": "English"
-    })
-    
-    end_time = time.time()
-    response_time = end_time - start_time
-    
-    assert response.status_code == 200
-    assert response_time < 5  # Response should be under 5 seconds
\ No newline at end of file
+@pytest.mark.parametrize("payload, expected_status", [
+    (EMPTY_REQUEST, 422),  # Validation error
+    (HELLO_NO_LANGUAGE, 200),  # Invalid language should default to English
+], ids=["invalid_request", "empty_language"])
+async def test_chat_endpoint_error_handling(client, payload, expected_status):
+    response = await client.post("/chat", content=payload, headers=JSON_HEADERS)
+    assert response.status_code == expected_status
+
+async def test_chat_endpoint_performance(client):
+    # Time concurrent simple requests individually and check the 95th percentile
+    async def timed_post(payload):
+        start = time.perf_counter_ns()
+        response = await client.post("/chat", content=payload, headers=JSON_HEADERS)
+        return response, (time.perf_counter_ns() - start) / 1000
+
+    profiler = None
+    if os.getenv("PROFILE") == "1":
+        # Opt-in: PROFILE=1 writes a pyinstrument report of the timed requests to perf.html
+        from pyinstrument import Profiler
+        profiler = Profiler(async_mode="enabled")
+        profiler.start()
+
+    results = await asyncio.gather(*(timed_post(payload) for payload in PERF_PAYLOADS))
+
+    if profiler is not None:
+        profiler.stop()
+        Path("perf.html").write_text(profiler.output_html())
+
+    assert all(response.status_code == 200 for response, _ in results)
+    p95 = statistics.quantiles([latency for _, latency in results], n=20)[-1]
+    assert p95 < PERF_P95_BUDGET_US
+    server_times = [float(response.headers["x-response-time"].rstrip("ms")) for response, _ in results]
+    assert statistics.quantiles(server_times, n=20)[-1] < SERVER_TIME_P95_BUDGET_MS
@@ -0,0 +1,21 @@
+import pytest
+from httpx import ASGITransport, AsyncClient
+from main import app
+
+# Needs AWS credentials, the S3 bucket and the model; run with: pytest -m integration
+pytestmark = pytest.mark.integration
+
+@pytest.mark.asyncio
+async def test_chat_endpoint_with_real_service():
+    # ASGITransport does not run the lifespan, so start the real chat service here
+    async with app.router.lifespan_context(app):
+        async with AsyncClient(transport=ASGITransport(app=app), base_url="http://testserver") as client:
+            response = await client.post("/chat", json={
+                "message": "What are your business hours?",
+                "language": "English"
+            })
+
+    assert response.status_code == 200
+    response_data = response.json()
+    assert response_data["response"]
+    assert response_data["language"] == "English"
@@ -0,0 +1,211 @@
+import pytest
+from hashlib import md5
+from datetime import datetime, timedelta
+from botocore.exceptions import ClientError
+from langchain_core.messages import HumanMessage, AIMessage
+from src.services import s3_memory_saver as s3_memory_saver_module
+from src.services.s3_memory_saver import S3MemorySaver
+
+class FakeBody:
+    def __init__(self, content):
+        self.content = content
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+    async def read(self):
+        return self.content
+
+class FakePaginator:
+    def __init__(self, client):
+        self.client = client
+
+    async def paginate(self, Bucket, Prefix, StartAfter=None):
+        self.client.list_calls.append({'Prefix': Prefix, 'StartAfter': StartAfter})
+        keys = sorted(k for k in self.client.objects if k.startswith(Prefix) and (StartAfter is None or k > StartAfter))
+        yield {'Contents': [{'Key': k, 'LastModified': self.client.objects[k]['LastModified']} for k in keys]}
+
+class FakeS3Client:
+    """In-memory stand-in for the parts of the aioboto3 S3 client the saver uses."""
+
+    def __init__(self):
+        self.objects = {}
+        self.list_calls = []
+        self.get_calls = []
+
+    async def put_object(self, Bucket, Key, Body, ContentType=None, ContentEncoding=None):
+        self.objects[Key] = {
+            'Body': Body,
+            'ContentEncoding': ContentEncoding,
+            'ETag': f'"{md5(Body).hexdigest()}"',
+            'LastModified': datetime.now()
+        }
+
+    async def get_object(self, Bucket, Key, Range=None, IfMatch=None):
+        self.get_calls.append({'Key': Key, 'Range': Range, 'IfMatch': IfMatch})
+        if Key not in self.objects:
+            raise ClientError({'Error': {'Code': 'NoSuchKey'}}, 'GetObject')
+        obj = self.objects[Key]
+        if IfMatch is not None and IfMatch != obj['ETag']:
+            raise ClientError({'Error': {'Code': 'PreconditionFailed'}}, 'GetObject')
+        content = obj['Body']
+        first, last = (int(n) for n in Range[len('bytes='):].split('-'))
+        response = {
+            'Body': FakeBody(content[first:last + 1]),
+            'ETag': obj['ETag'],
+            'ContentRange': f"bytes {first}-{min(last, len(content) - 1)}/{len(content)}"
+        }
+        if obj['ContentEncoding']:
+            response['ContentEncoding'] = obj['ContentEncoding']
+        return response
+
+    async def delete_object(self, Bucket, Key):
+        del self.objects[Key]
+
+    def get_paginator(self, operation_name):
+        return FakePaginator(self)
+
+@pytest.fixture
+def s3_client():
+    return FakeS3Client()
+
+@pytest.fixture
+def saver(s3_client):
+    return S3MemorySaver(bucket_name="test-bucket", s3_client=s3_client)
+
+@pytest.mark.asyncio
+async def test_put_writes_each_turn_as_its_own_object(saver, s3_client):
+    # Arrange
+    first_turn = [HumanMessage(content="Hello"), AIMessage(content="Hi there!")]
+    second_turn = first_turn + [HumanMessage(content="Bye"), AIMessage(content="Goodbye!")]
+
+    # Act
+    await saver.put("test-session", {"messages": first_turn, "language": "English"})
+    await saver.put("test-session", {"messages": second_turn, "language": "English"})
+
+    # Assert
+    assert sorted(s3_client.objects) == [
+        "chat_histories/test-session/turn-000000.json",
+        "chat_histories/test-session/turn-000001.json"
+    ]
+
+@pytest.mark.asyncio
+async def test_put_rejects_a_shorter_history(saver):
+    # Arrange
+    messages = [HumanMessage(content="Hello"), AIMessage(content="Hi there!")]
+    await saver.put("test-session", {"messages": messages})
+
+    # Act / Assert
+    with pytest.raises(ValueError):
+        await saver.put("test-session", {"messages": messages[:1]})
+
+@pytest.mark.asyncio
+async def test_get_starts_from_legacy_history(saver, s3_client):
+    # Arrange
+    legacy = b'{"messages": [{"_type": "HumanMessage", "content": "Hello", "additional_kwargs": {}, "type": "human"}], "language": "Spanish"}'
+    await s3_client.put_object(Bucket="test-bucket", Key="chat_histories/test-session.json", Body=legacy)
+    other = S3MemorySaver(bucket_name="test-bucket", s3_client=s3_client)
+    await other.put("test-session", {"messages": [HumanMessage(content="Hello"), AIMessage(content="Hola!")], "language": "Spanish"})
+
+    # Act
+    state = await saver.get("test-session")
+
+    # Assert
+    assert [m.content for m in state["messages"]] == ["Hello", "Hola!"]
+    assert state["language"] == "Spanish"
+    assert "chat_histories/test-session/turn-000000.json" in s3_client.objects
+
+@pytest.mark.asyncio
+async def test_get_lists_only_turns_written_since_last_read(saver, s3_client):
+    # Arrange
+    writer = S3MemorySaver(bucket_name="test-bucket", s3_client=s3_client)
+    first_turn = [HumanMessage(content="Hello"), AIMessage(content="Hi there!")]
+    await writer.put("test-session", {"messages": first_turn})
+    await saver.get("test-session")
+    await writer.put("test-session", {"messages": first_turn + [HumanMessage(content="Bye")]})
+
+    # Act
+    state = await saver.get("test-session")
+
+    # Assert
+    assert s3_client.list_calls[-1]["StartAfter"] == "chat_histories/test-session/turn-000000.json"
+    assert [m.content for m in state["messages"]] == ["Hello", "Hi there!", "Bye"]
+
+@pytest.mark.asyncio
+async def test_cleanup_keeps_sessions_with_a_recent_turn(saver, s3_client):
+    # Arrange
+    await saver.put("active-session", {"messages": [HumanMessage(content="Hello")]})
+    await saver.put("active-session", {"messages": [HumanMessage(content="Hello"), AIMessage(content="Hi there!")]})
+    await saver.put("stale-session", {"messages": [HumanMessage(content="Hello")]})
+    await s3_client.put_object(Bucket="test-bucket", Key="chat_histories/legacy-session.json", Body=b'{}')
+    old = datetime.now() - timedelta(days=40)
+    for key, obj in s3_client.objects.items():
+        if not key.endswith("turn-000001.json"):
+            obj["LastModified"] = old
+
+    # Act
+    await saver.cleanup_old_sessions(max_age_days=30)
+
+    # Assert
+    assert sorted(s3_client.objects) == [
+        "chat_histories/active-session/turn-000000.json",
+        "chat_histories/active-session/turn-000001.json"
+    ]
+
+@pytest.mark.asyncio
+async def test_get_reads_large_objects_in_ranges_of_one_version(saver, s3_client, monkeypatch):
+    # Arrange
+    monkeypatch.setattr(s3_memory_saver_module, "RANGE_CHUNK_SIZE", 16)
+    messages = [HumanMessage(content="Hello " * 20), AIMessage(content="Hi there!")]
+    writer = S3MemorySaver(bucket_name="test-bucket", s3_client=s3_client)
+    await writer.put("test-session", {"messages": messages})
+    s3_client.get_calls.clear()
+
+    # Act
+    state = await saver.get("test-session")
+
+    # Assert
+    turn_reads = [c for c in s3_client.get_calls if c["Key"].endswith("turn-000000.json")]
+    assert len(turn_reads) > 1
+    assert turn_reads[0]["IfMatch"] is None
+    etag = s3_client.objects["chat_histories/test-session/turn-000000.json"]["ETag"]
+    assert all(c["IfMatch"] == etag for c in turn_reads[1:])
+    assert [m.content for m in state["messages"]] == [m.content for m in messages]
+
+@pytest.mark.asyncio
+async def test_put_then_get_round_trips_compressed_turns(saver, s3_client):
+    # Arrange
+    messages = [
+        HumanMessage(content="Hello", additional_kwargs={"ts": 1700000000.0}),
+        AIMessage(content="Hi there!", additional_kwargs={"ts": 1700000001.0})
+    ]
+    await saver.put("test-session", {"messages": messages, "language": "English"})
+    reader = S3MemorySaver(bucket_name="test-bucket", s3_client=s3_client)
+
+    # Act
+    state = await reader.get("test-session")
+
+    # Assert
+    stored = s3_client.objects["chat_histories/test-session/turn-000000.json"]
+    assert stored["ContentEncoding"] == "zstd"
+    assert not stored["Body"].startswith(b"{")
+    assert [(type(m), m.content, m.additional_kwargs) for m in state["messages"]] == [
+        (type(m), m.content, m.additional_kwargs) for m in messages
+    ]
+    assert state["language"] == "English"
+
+@pytest.mark.asyncio
+async def test_get_reads_turns_stored_without_content_encoding(saver, s3_client):
+    # Arrange
+    turn = b'{"state": {"messages": [{"_type": "AIMessage", "content": "Hi there!", "additional_kwargs": {}, "type": "ai"}]}}'
+    await s3_client.put_object(Bucket="test-bucket", Key="chat_histories/test-session/turn-000000.json", Body=turn)
+
+    # Act
+    state = await saver.get("test-session")
+
+    # Assert
+    assert isinstance(state["messages"][0], AIMessage)
+    assert state["messages"][0].content == "Hi there!"